@@ -20,10 +20,22 @@ class Attention2D(nn.Module):
         x = x.view(x.size(0), x.size(1), -1).permute(0, 2, 1)  # Bx4xHxW -> Bx(HxW)x4
         if self_attn:
             kv = torch.cat([x, kv], dim=1)
-        x = self.attn(x, kv, kv, need_weights=False)[0]
+        x = self._attention(x, kv)
         x = x.permute(0, 2, 1).view(*orig_shape)
         return x
 
+    def _attention(self, x, kv):
+        # same projections as self.attn (so checkpoints & LoRAs still apply), but calling scaled_dot_product_attention
+        # directly with batch-first heads, which picks the flash / memory efficient kernels
+        w_q, w_k, w_v = self.attn.in_proj_weight.chunk(3)
+        b_q, b_k, b_v = self.attn.in_proj_bias.chunk(3)
+        q = nn.functional.linear(x, w_q, b_q)
+        k = nn.functional.linear(kv, w_k, b_k)
+        v = nn.functional.linear(kv, w_v, b_v)
+        q, k, v = [t.view(t.size(0), t.size(1), self.attn.num_heads, -1).transpose(1, 2) for t in (q, k, v)]
+        x = nn.functional.scaled_dot_product_attention(q, k, v, dropout_p=self.attn.dropout if self.training else 0.0)
+        return self.attn.out_proj(x.transpose(1, 2).flatten(2))
+
 
 class LayerNorm2d(nn.LayerNorm):
     def __init__(self, *args, **kwargs):
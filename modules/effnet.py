@@ -1,3 +1,4 @@
+import torch
 import torchvision
 from torch import nn
 
@@ -15,3 +16,13 @@ class EfficientNetEncoder(nn.Module):
     def forward(self, x):
         return self.mapper(self.backbone(x))
 
+    def fold_input_normalization(self, mean, std):
+        # folds Normalize(mean, std) into the stem conv & batchnorm, exact except for the zero-padded border pixels
+        conv, norm = self.backbone[0][0], self.backbone[0][1]
+        mean = torch.tensor(mean, dtype=conv.weight.dtype, device=conv.weight.device).view(1, -1, 1, 1)
+        std = torch.tensor(std, dtype=conv.weight.dtype, device=conv.weight.device).view(1, -1, 1, 1)
+        with torch.no_grad():
+            conv.weight.div_(std)
+            norm.running_mean.add_((conv.weight * mean).sum(dim=(1, 2, 3)))
+        return self
+
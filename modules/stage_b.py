@@ -5,6 +5,14 @@ from torch import nn
 from .common import AttnBlock, LayerNorm2d, ResBlock, FeedForwardBlock, TimestepBlock
 
 
+def unwrap_block(block):
+    # blocks can be wrapped by FSDP and/or activation checkpointing: FSDP(checkpoint_wrapper(block))
+    for wrapped_attr in ['_fsdp_wrapped_module', '_checkpoint_wrapped_module']:
+        if hasattr(block, wrapped_attr):
+            block = getattr(block, wrapped_attr)
+    return block
+
+
 class StageB(nn.Module):
     def __init__(self, c_in=4, c_out=4, c_r=64, patch_size=2, c_cond=1280, c_hidden=[320, 640, 1280, 1280],
                  nhead=[-1, -1, 20, 20], blocks=[[2, 6, 28, 6], [6, 28, 6, 2]],
@@ -163,17 +171,12 @@ class StageB(nn.Module):
             x = downscaler(x)
             for i in range(len(repmap) + 1):
                 for block in down_block:
-                    if isinstance(block, ResBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  ResBlock)):
+                    inner_block = unwrap_block(block)
+                    if isinstance(inner_block, ResBlock):
                         x = block(x)
-                    elif isinstance(block, AttnBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  AttnBlock)):
+                    elif isinstance(inner_block, AttnBlock):
                         x = block(x, clip)
-                    elif isinstance(block, TimestepBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  TimestepBlock)):
+                    elif isinstance(inner_block, TimestepBlock):
                         x = block(x, r_embed)
                     else:
                         x = block(x)
@@ -188,21 +191,16 @@ class StageB(nn.Module):
         for i, (up_block, upscaler, repmap) in enumerate(block_group):
             for j in range(len(repmap) + 1):
                 for k, block in enumerate(up_block):
-                    if isinstance(block, ResBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  ResBlock)):
+                    inner_block = unwrap_block(block)
+                    if isinstance(inner_block, ResBlock):
                         skip = level_outputs[i] if k == 0 and i > 0 else None
                         if skip is not None and (x.size(-1) != skip.size(-1) or x.size(-2) != skip.size(-2)):
                             x = torch.nn.functional.interpolate(x.float(), skip.shape[-2:], mode='bilinear',
                                                                 align_corners=True)
                         x = block(x, skip)
-                    elif isinstance(block, AttnBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  AttnBlock)):
+                    elif isinstance(inner_block, AttnBlock):
                         x = block(x, clip)
-                    elif isinstance(block, TimestepBlock) or (
-                            hasattr(block, '_fsdp_wrapped_module') and isinstance(block._fsdp_wrapped_module,
-                                                                                  TimestepBlock)):
+                    elif isinstance(inner_block, TimestepBlock):
                         x = block(x, r_embed)
                     else:
                         x = block(x)
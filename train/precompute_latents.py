@@ -0,0 +1,62 @@
+import io
+import sys
+import yaml
+import torch
+import webdataset as wds
+from PIL import Image
+from torch import nn
+
+from train.train_b import WurstCore, effnet_size
+
+# Precomputes the Stage A latents & effnet embeddings of a webdataset shard, for training Stage B with
+# `precomputed_latents: True` and/or `precomputed_effnet: True`.
+# The samples are written back untouched, with extra `latents.pth` & `effnet.pth` (one embedding per effnet factor)
+# entries next to each image.
+# Usage: python3 train/precompute_latents.py <training config> <input shard .tar> <output shard .tar>
+
+
+def encode_and_write(samples, sink, core, effnet, stage_a, extras):
+    images = torch.stack([
+        extras.transforms(Image.open(io.BytesIO(s['jpg'] if 'jpg' in s else s['png'])).convert('RGB')) for s in samples
+    ], dim=0).to(core.device)
+    latents = stage_a.encode(images.to(core.frozen_dtype(), memory_format=torch.channels_last))[0].cpu()
+    effnet_embeddings = []
+    for effnet_factor in core.effnet_factors:
+        effnet_height, effnet_width = effnet_size(images.size(-2), images.size(-1), effnet_factor)
+        effnet_images = nn.functional.interpolate(images, size=(effnet_height, effnet_width), mode='nearest')
+        effnet_embeddings.append(core.get_effnet_embeddings(effnet_images, effnet, extras).cpu())
+    for i, sample in enumerate(samples):
+        # cloned, otherwise the whole batch storage is saved
+        sink.write({
+            **sample,
+            'latents.pth': latents[i].clone(),
+            'effnet.pth': [e[i].clone() for e in effnet_embeddings],
+        })
+
+
+def main(config_file_path, input_path, output_path, batch_size=16):
+    with open(config_file_path, "r", encoding="utf-8") as file:
+        config_dict = yaml.safe_load(file)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    # same image transforms & frozen models as the training will use with precomputed data
+    core = WurstCore(config_dict={**config_dict, 'precomputed_latents': True, 'precomputed_effnet': True}, device=device)
+    extras = core.setup_extras_pre()
+    effnet, stage_a = core.setup_frozen_models()
+
+    with torch.no_grad(), wds.TarWriter(output_path) as sink:
+        samples = []
+        for sample in wds.WebDataset(input_path):
+            samples.append(sample)
+            if len(samples) == batch_size:
+                encode_and_write(samples, sink, core, effnet, stage_a, extras)
+                samples = []
+        if len(samples) > 0:
+            encode_and_write(samples, sink, core, effnet, stage_a, extras)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4:
+        print('Usage: python3 train/precompute_latents.py <training config> <input shard .tar> <output shard .tar>')
+        sys.exit(1)
+    main(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -8,6 +8,7 @@ import numpy as np
 import sys
 import os
 from dataclasses import dataclass
+from functools import lru_cache
 
 from gdf import GDF, EpsilonTarget, CosineSchedule
 from gdf import VPScaler, CosineTNoiseCond, DDPMSampler, P2LossWeight, AdaptiveLossWeight
@@ -26,10 +27,37 @@ from core.utils import EXPECTED, EXPECTED_TRAIN, load_or_fail
 
 from torch.distributed.fsdp import FullyShardedDataParallel as FSDP
 from torch.distributed.fsdp.wrap import ModuleWrapPolicy
+from torch.distributed.algorithms._checkpoint.checkpoint_wrapper import apply_activation_checkpointing
 from accelerate import init_empty_weights
 from accelerate.utils import set_module_tensor_to_device
 from contextlib import contextmanager
 
+@lru_cache(maxsize=None)
+def pyramid_noise_levels(size, size_range=None, levels=10):
+    pyramid_levels = []  # (h, w, multiplier) of every level added on top of the base noise
+    for i in range(1, levels):
+        m = 0.75 ** i
+        h, w = size // (2 ** i), size // (2 ** i)
+        if size_range is None or (size_range[0] <= h <= size_range[1] or size_range[0] <= w <= size_range[1]):
+            pyramid_levels.append((h, w, m))
+        if h <= 1 or w <= 1:
+            break
+    inv_norm = 1.0 / (1 + sum(m ** 2 for _, _, m in pyramid_levels)) ** 0.5
+    return tuple(pyramid_levels), inv_norm
+
+@lru_cache(maxsize=None)
+def effnet_size(height, width, effnet_factor):
+    return int(((height*effnet_factor)//32)*32), int(((width*effnet_factor)//32)*32)
+
+def pyramid_noise(epsilon, offsets, pyramid_levels, inv_norm, scale_mode='nearest'):
+    b, c = epsilon.shape[:2]
+    start = 0
+    for h, w, m in pyramid_levels:
+        offset = offsets[start:start + b * c * h * w].view(b, c, h, w)
+        epsilon = epsilon + torch.nn.functional.interpolate(offset, size=epsilon.shape[-2:], mode=scale_mode) * m
+        start += b * c * h * w
+    return epsilon.mul_(inv_norm)
+
 class WurstCore(TrainingCore, DataCore, WarpCore):
     @dataclass(frozen=True)
     class Config(TrainingCore.Config, DataCore.Config, WarpCore.Config):
@@ -51,6 +79,22 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
         # gdf customization
         adaptive_loss_weight: str = None
 
+        # read the Stage A latents / effnet embeddings from the dataset instead of encoding them every step,
+        # see train/precompute_latents.py
+        precomputed_latents: bool = None
+        precomputed_effnet: bool = None
+
+        # trade recomputation for activation memory
+        activation_checkpointing: bool = None
+
+        # TORCH COMPILE
+        compile_frozen_models: bool = None
+        compile_generator: bool = None
+        compile_pyramid_noise: bool = None  # one graph per latent size, so mostly useful without multi_aspect_ratio
+
+        # fold the effnet input normalization into its first conv (slightly changes the border of the embeddings)
+        fold_effnet_preprocess: bool = None
+
     @dataclass(frozen=True)
     class Models(TrainingCore.Models, DataCore.Models, WarpCore.Models):
         effnet: nn.Module = EXPECTED
@@ -69,6 +113,20 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
     info: TrainingCore.Info
     config: Config
 
+    # bf16 mixed precision & limited all-gathers come from WarpCore, BACKWARD_PRE backward prefetching is already the
+    # FSDP default, forward prefetching additionally overlaps the next all-gather with the current forward compute
+    fsdp_defaults = {
+        **WarpCore.fsdp_defaults,
+        "forward_prefetch": True,
+    }
+
+    # a fixed set of effnet resize factors keeps the number of effnet input shapes bounded
+    effnet_factors = (0.5, 0.625, 0.75, 0.875, 1.0)
+    effnet_mean, effnet_std = (0.485, 0.456, 0.406), (0.229, 0.224, 0.225)
+    effnet_buffer = None
+    pyramid_noise = staticmethod(pyramid_noise)  # replaced by its compiled version in setup_models if requested
+    device_rng = None
+
     def setup_extras_pre(self) -> Extras:
         gdf = GDF(
             schedule=CosineSchedule(clamp_range=[0.0001, 0.9999]),
@@ -84,16 +142,16 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
 
         effnet_preprocess = torchvision.transforms.Compose([
             torchvision.transforms.Normalize(
-                mean=(0.485, 0.456, 0.406), std=(0.229, 0.224, 0.225)
+                mean=self.effnet_mean, std=self.effnet_std
             )
-        ])
+        ] if not self.config.fold_effnet_preprocess else [])  # otherwise folded into the effnet in setup_models
 
         transforms = torchvision.transforms.Compose([
             torchvision.transforms.ToTensor(),
             torchvision.transforms.Resize(self.config.image_size,
                                         interpolation=torchvision.transforms.InterpolationMode.BILINEAR,
                                         antialias=True),
-            SmartCrop(self.config.image_size, randomize_p=0.3, randomize_q=0.2) if self.config.training else torchvision.transforms.CenterCrop(self.config.image_size)
+            SmartCrop(self.config.image_size, randomize_p=0.3, randomize_q=0.2) if self.config.training and not self.uses_precomputed_data() else torchvision.transforms.CenterCrop(self.config.image_size)
         ])
 
         return self.Extras(
@@ -104,26 +162,72 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
             clip_preprocess=None
         )
 
+    def uses_precomputed_data(self):
+        return bool(self.config.precomputed_latents or self.config.precomputed_effnet)
+
+    def webdataset_preprocessors(self, extras: Extras):
+        preprocessors = super().webdataset_preprocessors(extras)
+        if self.uses_precomputed_data():
+            # precomputed from center crops, random crops & aspect ratio buckets wouldn't match them
+            assert self.config.multi_aspect_ratio is None, "precomputed latents/effnet embeddings don't support multi_aspect_ratio"
+        if self.config.precomputed_latents:
+            preprocessors += [('latents.pth', lambda x: x, 'latents')]
+        if self.config.precomputed_effnet:
+            preprocessors += [('effnet.pth', lambda x: x, 'effnet_embeddings')]  # one embedding per effnet factor
+        return preprocessors
+
+    def frozen_dtype(self):
+        # only training runs the frozen models in bf16, inference (which may run on the cpu) keeps them in fp32
+        return torch.bfloat16 if self.config.training else torch.float32
+
+    def get_effnet_embeddings(self, effnet_images, effnet: nn.Module, extras: Extras):
+        return effnet(extras.effnet_preprocess(effnet_images).to(self.frozen_dtype(), memory_format=torch.channels_last))
+
+    def get_device_rng(self):
+        # persistent on-device generator for the per-step randomness, so no host rng values need to be moved to the GPU
+        if self.device_rng is None:
+            self.device_rng = torch.Generator(device=self.device)
+            self.device_rng.seed()  # non-deterministic seed, otherwise every rank would draw the same noise
+        return self.device_rng
+
+    def get_effnet_buffer(self, batch_size, height, width):
+        # persistent buffer for the effnet embeddings, grown to the largest shape seen so far instead of allocated every step
+        buffer = self.effnet_buffer
+        if buffer is None or buffer.size(0) < batch_size or buffer.size(-2) < height or buffer.size(-1) < width:
+            if buffer is not None:
+                batch_size, height, width = max(batch_size, buffer.size(0)), max(height, buffer.size(-2)), max(width, buffer.size(-1))
+            self.effnet_buffer = torch.empty(batch_size, 16, height, width, device=self.device)
+        return self.effnet_buffer
+
     def get_conditions(self, batch: dict, models: Models, extras: Extras, is_eval=False, is_unconditional=False, eval_image_embeds=False, return_fields=None):
         images = batch.get('images', None)
 
         if images is not None:
             images = images.to(self.device)
             if is_eval and not is_unconditional:
-                effnet_embeddings = models.effnet(extras.effnet_preprocess(images))
+                # cloned, the output of a cuda-graphed (compile_frozen_models) effnet is overwritten by the next call
+                effnet_embeddings = self.get_effnet_embeddings(images, models.effnet, extras).clone()
             else:
                 if is_eval:
                     effnet_factor = 1
                 else:
-                    effnet_factor = np.random.uniform(0.5, 1) # f64 to f32
-                effnet_height, effnet_width = int(((images.size(-2)*effnet_factor)//32)*32), int(((images.size(-1)*effnet_factor)//32)*32)
-
-                effnet_embeddings = torch.zeros(images.size(0), 16, effnet_height//32, effnet_width//32, device=self.device)
-                if not is_eval:
-                    effnet_images = torchvision.transforms.functional.resize(images, (effnet_height, effnet_width), interpolation=torchvision.transforms.InterpolationMode.NEAREST)
-                    rand_idx = np.random.rand(len(images)) <= 0.9
-                    if any(rand_idx):
-                        effnet_embeddings[rand_idx] = models.effnet(extras.effnet_preprocess(effnet_images[rand_idx]))
+                    effnet_factor_idx = np.random.randint(len(self.effnet_factors))
+                    effnet_factor = self.effnet_factors[effnet_factor_idx]
+                effnet_height, effnet_width = effnet_size(images.size(-2), images.size(-1), effnet_factor)
+
+                effnet_embeddings = self.get_effnet_buffer(images.size(0), effnet_height//32, effnet_width//32)
+                effnet_embeddings = effnet_embeddings[:images.size(0), :, :effnet_height//32, :effnet_width//32]
+                if is_eval:
+                    effnet_embeddings.zero_()
+                else:
+                    if 'effnet_embeddings' in batch:
+                        batch_embeddings = batch['effnet_embeddings'][effnet_factor_idx].to(self.device, non_blocking=True)
+                    else:
+                        effnet_images = nn.functional.interpolate(images, size=(effnet_height, effnet_width), mode='nearest')
+                        batch_embeddings = self.get_effnet_embeddings(effnet_images, models.effnet, extras)
+                    # the whole batch is embedded so the effnet shapes stay static, dropped samples are masked on the GPU
+                    keep_mask = torch.rand(images.size(0), device=self.device, generator=self.get_device_rng()) <= 0.9
+                    torch.mul(batch_embeddings, keep_mask.view(-1, 1, 1, 1), out=effnet_embeddings)
         else:
             effnet_embeddings = None
             
@@ -134,14 +238,23 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
 
         return {'effnet': effnet_embeddings, 'clip': conditions['clip_text_pooled']}
 
-    def setup_models(self, extras: Extras, skip_clip: bool = False) -> Models:
-        dtype = getattr(torch, self.config.dtype) if self.config.dtype else torch.float32
+    def setup_frozen_models(self):
+        if self.config.training:
+            # process-wide, only for training & precomputing where the frozen conv models see a bounded set of input
+            # shapes, inference runs arbitrary resolutions
+            torch.backends.cudnn.benchmark = True
 
         # EfficientNet encoder
         effnet = EfficientNetEncoder().to(self.device)
         effnet_checkpoint = load_or_fail(self.config.effnet_checkpoint_path)
         effnet.load_state_dict(effnet_checkpoint if 'state_dict' not in effnet_checkpoint else effnet_checkpoint['state_dict'])
+        if self.config.fold_effnet_preprocess:
+            effnet.fold_input_normalization(self.effnet_mean, self.effnet_std)
         effnet.eval().requires_grad_(False)
+        if self.config.training:
+            # bf16 weights for speed & memory, not to save a cast: these ran in fp32 outside autocast before, so this
+            # lowers the effnet embeddings & the Stage A latents the generator is trained on to bf16 precision
+            effnet.to(self.frozen_dtype(), memory_format=torch.channels_last)
         del effnet_checkpoint
 
         # vqGAN
@@ -149,8 +262,22 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
         stage_a_checkpoint = load_or_fail(self.config.stage_a_checkpoint_path)
         stage_a.load_state_dict(stage_a_checkpoint if 'state_dict' not in stage_a_checkpoint else stage_a_checkpoint['state_dict'])
         stage_a.eval().requires_grad_(False)
+        if self.config.training:
+            stage_a.to(self.frozen_dtype(), memory_format=torch.channels_last)
         del stage_a_checkpoint
 
+        if self.config.compile_frozen_models:
+            # frozen & shape-stable per bucket, decode is only used for sampling so it stays eager
+            effnet.forward = torch.compile(effnet.forward, mode="reduce-overhead", fullgraph=True, dynamic=False)
+            stage_a.encode = torch.compile(stage_a.encode, mode="reduce-overhead", fullgraph=True, dynamic=False)
+
+        return effnet, stage_a
+
+    def setup_models(self, extras: Extras, skip_clip: bool = False) -> Models:
+        dtype = getattr(torch, self.config.dtype) if self.config.dtype else torch.float32
+
+        effnet, stage_a = self.setup_frozen_models()
+
         @contextmanager
         def dummy_context():
             yield None
@@ -191,16 +318,35 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
 
         if self.config.use_fsdp:
             fsdp_auto_wrap_policy = ModuleWrapPolicy([ResBlock, AttnBlock, TimestepBlock, FeedForwardBlock])
-            generator = FSDP(generator, **self.fsdp_defaults, auto_wrap_policy=fsdp_auto_wrap_policy, device_id=self.device)
+            # torch.compile needs the original params, the ema has to match so update_weights_ema pairs the same params
+            use_orig_params = self.config.compile_generator is True
+            generator = FSDP(generator, **self.fsdp_defaults, auto_wrap_policy=fsdp_auto_wrap_policy, device_id=self.device,
+                             use_orig_params=use_orig_params)
             if generator_ema is not None:
-                generator_ema = FSDP(generator_ema, **self.fsdp_defaults, auto_wrap_policy=fsdp_auto_wrap_policy, device_id=self.device)
+                generator_ema = FSDP(generator_ema, **self.fsdp_defaults, auto_wrap_policy=fsdp_auto_wrap_policy, device_id=self.device,
+                                     use_orig_params=use_orig_params)
+
+        if self.config.activation_checkpointing:
+            # applied after FSDP wrapping, so that every FSDP unit wraps a checkpointed block: FSDP(checkpoint_wrapper(block))
+            apply_activation_checkpointing(
+                generator, check_fn=lambda m: isinstance(m, (ResBlock, AttnBlock, TimestepBlock, FeedForwardBlock))
+            )
+
+        if self.config.compile_pyramid_noise:
+            self.pyramid_noise = torch.compile(pyramid_noise, fullgraph=True, dynamic=False)
+
+        if self.config.compile_generator:
+            # cuda graphs (reduce-overhead) don't work with FSDP's all-gathers, so FSDP falls back to the default mode
+            # the ema model is only used for weight copies and sampling, so it stays eager
+            generator.forward = torch.compile(generator.forward, backend="inductor",
+                                              mode="default" if self.config.use_fsdp else "reduce-overhead")
 
         if skip_clip:
             tokenizer = None
             text_model = None
         else:
             tokenizer = AutoTokenizer.from_pretrained(self.config.clip_text_model_name)
-            text_model = CLIPTextModelWithProjection.from_pretrained(self.config.clip_text_model_name).requires_grad_(False).to(dtype).to(self.device)
+            text_model = CLIPTextModelWithProjection.from_pretrained(self.config.clip_text_model_name, torch_dtype=dtype).requires_grad_(False).to(self.device)
 
         return self.Models(
             effnet=effnet, stage_a=stage_a,
@@ -209,9 +355,11 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
         )
 
     def setup_optimizers(self, extras: Extras, models: Models) -> TrainingCore.Optimizers:
-        optimizer = optim.AdamW(models.generator.parameters(), lr=self.config.lr)  # , eps=1e-7, betas=(0.9, 0.95))
+        optimizer = optim.AdamW(models.generator.parameters(), lr=self.config.lr, fused=True)  # , eps=1e-7, betas=(0.9, 0.95))
         optimizer = self.load_optimizer(optimizer, 'generator_optim',
                                         fsdp_model=models.generator if self.config.use_fsdp else None)
+        for param_group in optimizer.param_groups:
+            param_group['fused'] = True  # load_state_dict restores the saved param groups, older checkpoints aren't fused
         return self.Optimizers(generator=optimizer)
 
     def setup_schedulers(self, extras: Extras, models: Models,
@@ -221,29 +369,21 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
         return self.Schedulers(generator=scheduler)
 
     def _pyramid_noise(self, epsilon, size_range=None, levels=10, scale_mode='nearest'):
-        epsilon = epsilon.clone()
-        multipliers = [1]
-        for i in range(1, levels):
-            m = 0.75 ** i
-            h, w = epsilon.size(-2) // (2 ** i), epsilon.size(-2) // (2 ** i)
-            if size_range is None or (size_range[0] <= h <= size_range[1] or size_range[0] <= w <= size_range[1]):
-                offset = torch.randn(epsilon.size(0), epsilon.size(1), h, w, device=self.device)
-                epsilon = epsilon + torch.nn.functional.interpolate(offset, size=epsilon.shape[-2:],
-                                                                    mode=scale_mode) * m
-                multipliers.append(m)
-            if h <= 1 or w <= 1:
-                break
-        epsilon = epsilon / sum([m ** 2 for m in multipliers]) ** 0.5
-        # epsilon = epsilon / epsilon.std()
-        return epsilon
+        pyramid_levels, inv_norm = pyramid_noise_levels(epsilon.size(-2), tuple(size_range) if size_range is not None else None, levels)
+        # a single randn call for all the levels, sliced into per-level offsets by pyramid_noise
+        offsets = torch.randn(epsilon.size(0) * epsilon.size(1) * sum(h * w for h, w, _ in pyramid_levels),
+                              device=self.device, generator=self.get_device_rng())
+        return self.pyramid_noise(epsilon, offsets, pyramid_levels, inv_norm, scale_mode)
 
     def forward_pass(self, data: WarpCore.Data, extras: Extras, models: Models):
         batch = next(data.iterator)
+        # moved once (asynchronously from the pinned dataloader memory) and shared by get_conditions & encode_latents
+        batch['images'] = batch['images'].to(self.device, non_blocking=True)
 
         with torch.no_grad():
             conditions = self.get_conditions(batch, models, extras)
             latents = self.encode_latents(batch, models, extras)
-            epsilon = torch.randn_like(latents)
+            epsilon = torch.randn(latents.shape, dtype=latents.dtype, device=self.device, generator=self.get_device_rng())
             epsilon = self._pyramid_noise(epsilon, size_range=[1, 16])
             noised, noise, target, logSNR, noise_cond, loss_weight = extras.gdf.diffuse(latents, shift=1, loss_shift=1,
                                                                                         epsilon=epsilon)
@@ -262,18 +402,13 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
                       schedulers: Schedulers):
         if update:
             loss_adjusted.backward()
-            grad_norm = nn.utils.clip_grad_norm_(models.generator.parameters(), 1.0)
-            optimizers_dict = optimizers.to_dict()
-            for k in optimizers_dict:
-                if k != 'training':
-                    optimizers_dict[k].step()
-            schedulers_dict = schedulers.to_dict()
-            for k in schedulers_dict:
-                if k != 'training':
-                    schedulers_dict[k].step()
-            for k in optimizers_dict:
-                if k != 'training':
-                    optimizers_dict[k].zero_grad(set_to_none=True)
+            if self.config.use_fsdp:
+                grad_norm = models.generator.clip_grad_norm_(1.0)  # sharding aware
+            else:
+                grad_norm = nn.utils.clip_grad_norm_(models.generator.parameters(), 1.0, foreach=True)
+            optimizers.generator.step()
+            schedulers.generator.step()
+            optimizers.generator.zero_grad(set_to_none=True)
             self.info.total_steps += 1
         else:
             loss_adjusted.backward()
@@ -285,15 +420,19 @@ class WurstCore(TrainingCore, DataCore, WarpCore):
         return ['generator', 'generator_ema']
 
     def encode_latents(self, batch: dict, models: Models, extras: Extras) -> torch.Tensor:
-        images = batch['images'].to(self.device)
-        return models.stage_a.encode(images)[0]
+        if 'latents' in batch:
+            return batch['latents'].to(self.device, non_blocking=True).float()
+        images = batch['images'].to(self.device, dtype=self.frozen_dtype(), memory_format=torch.channels_last)
+        return models.stage_a.encode(images)[0].float()  # .float() also copies the latents out of cuda graph memory
 
     def decode_latents(self, latents: torch.Tensor, batch: dict, models: Models, extras: Extras) -> torch.Tensor:
-        return models.stage_a.decode(latents.float()).clamp(0, 1)
+        return models.stage_a.decode(latents.to(self.frozen_dtype())).float().clamp(0, 1)
 
 
 if __name__ == '__main__':
     print("Launching Script")
+    # the varying effnet/latent shapes & FSDP all-gathers fragment the caching allocator, has to be set before CUDA is initialized
+    os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
     warpcore = WurstCore(
         config_file_path=sys.argv[1] if len(sys.argv) > 1 else None,
         device=torch.device(int(os.environ.get("SLURM_LOCALID")))